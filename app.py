@@ -3,8 +3,19 @@ from dotenv import load_dotenv
 
 import bleach
 import calendar
-from datetime import datetime, date, timedelta, timezone
-from markdown import markdown
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import groupby
+from operator import attrgetter
+from datetime import datetime, date, timezone
+from bleach.linkifier import Linker
+from bleach.sanitizer import Cleaner
+from markdown import Markdown
+from sqlalchemy import event
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import func
 
 from flask import (
@@ -17,6 +28,7 @@ from flask import (
     abort,
     jsonify,
 )
+from flask.helpers import get_debug_flag
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
     LoginManager,
@@ -28,6 +40,7 @@ from flask_login import (
 )
 from flask_migrate import Migrate
 
+from werkzeug.routing import BaseConverter, ValidationError
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 
@@ -92,6 +105,8 @@ ALLOWED_TAGS = bleach.sanitizer.ALLOWED_TAGS.union(
         "img",
     }
 )
+# bleach に渡すリストは import 時に 1 回だけ作る
+_ALLOWED_TAGS_LIST = list(ALLOWED_TAGS)
 ALLOWED_ATTRS = {
     "a": ["href", "title", "rel"],
     "code": ["class"],
@@ -103,21 +118,144 @@ ALLOWED_ATTRS = {
 ALLOWED_PROTOCOLS = ["http", "https", "mailto"]
 
 
+# Cleaner / Linker / Markdown は作るのが重いのでスレッドごとに 1 つだけ作って使いまわす
+_local = threading.local()
+
+
+def _get_cleaner() -> Cleaner:
+    cleaner = getattr(_local, "cleaner", None)
+    if cleaner is None:
+        cleaner = _local.cleaner = Cleaner(
+            tags=_ALLOWED_TAGS_LIST,
+            attributes=ALLOWED_ATTRS,
+            protocols=ALLOWED_PROTOCOLS,
+            strip=True,
+        )
+    return cleaner
+
+
+def _get_linker() -> Linker:
+    linker = getattr(_local, "linker", None)
+    if linker is None:
+        linker = _local.linker = Linker()
+    return linker
+
+
 def sanitize_html(html: str) -> str:
-    cleaned = bleach.clean(
-        html,
-        tags=list(ALLOWED_TAGS),
-        attributes=ALLOWED_ATTRS,
-        protocols=ALLOWED_PROTOCOLS,
-        strip=True,
-    )
-    cleaned = bleach.linkify(cleaned)
+    if not html:
+        return ""
+    cleaned = _get_cleaner().clean(html)
+    cleaned = _get_linker().linkify(cleaned)
     return cleaned
 
 
+# Markdown の HTML 化. 入力が同じなら出力も同じなのでキャッシュする
+
+MD_EXTENSIONS = (
+    "fenced_code",
+    "tables",
+    "sane_lists",
+    "pymdownx.superfences",
+    "pymdownx.highlight",
+    "pymdownx.tilde",
+    "pymdownx.tasklist",
+)
+# コードブロックまわり
+VIEW_EXTENSION_CONFIGS = {
+    "pymdownx.highlight": {
+        "use_pygments": True,
+        "noclasses": False,
+        "css_class": "highlight",
+        "linenums": True,
+    }
+}
+# プレビューは打鍵ごとに呼ばれるので Pygments は使わず, ブラウザ側 (highlight.js) で色付けする
+PREVIEW_EXTENSION_CONFIGS = {
+    "pymdownx.highlight": {
+        "use_pygments": False,
+        "css_class": "highlight",
+    }
+}
+
+
+# 用途ごとの設定. Markdown インスタンスはスレッドごと, 用途ごとに 1 つ
+_MD_CONFIGS = {
+    "view": VIEW_EXTENSION_CONFIGS,
+    "preview": PREVIEW_EXTENSION_CONFIGS,
+}
+
+
+def _render_markdown(text: str, kind: str) -> str:
+    mds = getattr(_local, "mds", None)
+    if mds is None:
+        mds = _local.mds = {}
+    md = mds.get(kind)
+    if md is None:
+        md = mds[kind] = Markdown(
+            extensions=MD_EXTENSIONS,
+            extension_configs=_MD_CONFIGS[kind],
+        )
+    # Markdown インスタンスは状態を持つので reset してから変換
+    return md.reset().convert(text)
+
+
+class _RenderCache:
+    """
+    本文の blake2b ハッシュをキーにした, スレッドセーフな LRU
+    本文そのものをキーにすると長い文字列を毎回ハッシュして持ち続けることになるので
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: OrderedDict[bytes, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, text: str, render) -> str:
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        with self._lock:
+            html = self._data.get(key)
+            if html is not None:
+                self._data.move_to_end(key)
+                return html
+
+        # 変換はロックの外で
+        html = render(text)
+
+        with self._lock:
+            self._data[key] = html
+            if len(self._data) > self.maxsize:
+                # いちばん古いものを捨てる
+                self._data.popitem(last=False)
+        return html
+
+
+_body_cache = _RenderCache(maxsize=1024)
+# プレビューは打鍵ごとに呼ばれるので, 直近の結果だけ覚えておく
+_preview_cache = _RenderCache(maxsize=128)
+
+
+def render_body_html(body: str) -> str:
+    """
+    エントリ本文を HTML 化してサニタイズしたものを返す
+    Pygments の行番号つきハイライトが重いので本文ごとにキャッシュ
+    """
+    return _body_cache.get_or_render(
+        body, lambda text: sanitize_html(_render_markdown(text, "view"))
+    )
+
+
+def render_preview_html(text: str) -> str:
+    return _preview_cache.get_or_render(
+        text, lambda text: sanitize_html(_render_markdown(text, "preview"))
+    )
+
+
 load_dotenv()
 
 app = Flask(__name__)
+# python app.py で起動したときはデバッグ. それ以外は FLASK_DEBUG に従う
+# モデル定義 (Entry.author の lazy) より前に決めておく
+app.config["DEBUG"] = __name__ == "__main__" or get_debug_flag()
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
 app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False  # 省エネ
@@ -129,15 +267,34 @@ login_manager = LoginManager(app)
 login_manager.login_view = "login"  # ログインしていないときのリダイレクト先
 
 
+class IsoDateConverter(BaseConverter):
+    """
+    URL の YYYY-MM-DD を date 型で受け取る. 不正な日付なら 404
+    """
+
+    regex = r"\d{4}-\d{2}-\d{2}"
+
+    def to_python(self, value: str) -> date:
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            raise ValidationError()
+
+    def to_url(self, value: date) -> str:
+        return value.isoformat()
+
+
+app.url_map.converters["isodate"] = IsoDateConverter
+
+
 class User(UserMixin, db.Model):
     # UserMixin で Flask-Login に必要な属性を読み込み
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
 
-    # User モデルは複数 Entry を持つよ. 逆方向参照.
-    # lazy で使うときに読み込むようにするよ
-    entries = db.relationship("Entry", backref="author", lazy=True)
+    # User モデルは複数 Entry を持つよ. 逆方向参照は Entry.author
+    entries = db.relationship("Entry", back_populates="author")
 
     def set_password(self, password: str):
         self.password_hash = generate_password_hash(password)
@@ -147,9 +304,16 @@ class User(UserMixin, db.Model):
 
 
 class Entry(db.Model):
+    # カレンダーと日ページは user_id + 日付 で絞り込むのでまとめて index を張る
+    __table_args__ = (
+        db.Index("ix_entry_user_created", "user_id", "created_at"),
+        db.Index("ix_entry_user_date", "user_id", "entry_date"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200))
-    body = db.Column(db.Text, nullable=False)
+    # 本文は大きいので必要なときだけ読み込む (undefer で明示する)
+    body = db.deferred(db.Column(db.Text, nullable=False))
     
     entry_date = db.Column(db.Date, nullable=False)
 
@@ -165,6 +329,27 @@ class Entry(db.Model):
 
     # User テーブルとの紐づけ
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    # 一覧で author を触るときは selectinload で先読みする (N+1 対策)
+    # デバッグ時はうっかり遅延読み込みしたら例外にして気づけるようにする
+    author = db.relationship(
+        "User",
+        back_populates="entries",
+        lazy="raise" if app.debug else "select",
+    )
+
+
+@event.listens_for(Entry, "load")
+@event.listens_for(Entry, "refresh")
+def _ensure_utc(target: Entry, *args) -> None:
+    """
+    SQLite は tzinfo を保存しないので, 読み込んだ時点で UTC をつけておく
+    set_committed_value なので dirty 扱いにはならない
+    """
+    for key in ("created_at", "updated_at"):
+        # 未ロードの属性に触ると読み込みが走るので __dict__ を見る
+        value = target.__dict__.get(key)
+        if value is not None and value.tzinfo is None:
+            set_committed_value(target, key, value.replace(tzinfo=timezone.utc))
 
 
 # 画像保存
@@ -183,6 +368,16 @@ def allowed_image_file(filename: str) -> bool:
     return ext in ALLOWED_IMAGE_EXTENSIONS
 
 
+# カレンダーの枠は (年, 月) だけで決まるのでキャッシュする
+_CAL = calendar.Calendar(firstweekday=6)  # 6: Sunday
+
+
+@lru_cache(maxsize=64)
+def _month_weeks(year: int, month: int) -> tuple[tuple[date, ...], ...]:
+    # 全リクエストで同じオブジェクトを返すので, 書き換えられないよう tuple にする
+    return tuple(tuple(week) for week in _CAL.monthdatescalendar(year, month))
+
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -198,32 +393,29 @@ def index():
         today = datetime.now(JST).date()
         year, month = today.year, today.month
 
-    cal = calendar.Calendar(firstweekday=6)  # 6: Sunday
-    weeks = cal.monthdatescalendar(year, month)
-
-    # JST で月の範囲指定
-    start_jst = datetime(year, month, 1, 0, 0, tzinfo=JST)
-    if month == 12:
-        end_jst = datetime(year + 1, 1, 1, 0, 0, tzinfo=JST)
-    else:
-        end_jst = datetime(year, month + 1, 1, 0, 0, tzinfo=JST)
-
-    # UTC で
-    start_dt = start_jst.astimezone(timezone.utc)
-    end_dt = end_jst.astimezone(timezone.utc)
-
-    month_entries = Entry.query.filter(
-        Entry.user_id == current_user.id,
-        Entry.created_at >= start_dt,
-        Entry.created_at < end_dt,
-    ).all()
-
-    # 日付でまとめる
-    entries_by_date: dict[date, list[Entry]] = {}
-    for e in month_entries:
-        # 保存されている datetime.datetime 型を datetime.date 型へ変換
-        d = to_jst(e.created_at).date()
-        entries_by_date.setdefault(d, []).append(e)
+    weeks = _month_weeks(year, month)
+
+    # entry_date は JST の日付なので, そのまま月の範囲で絞り込める
+    first_day = date(year, month, 1)
+    last_day = date(year, month, calendar.monthrange(year, month)[1])
+
+    # カレンダーには本文がいらないので必要な列だけ取ってくる
+    month_entries = (
+        db.session.query(Entry.id, Entry.title, Entry.entry_date)
+        .filter(
+            Entry.user_id == current_user.id,
+            Entry.entry_date >= first_day,
+            Entry.entry_date <= last_day,
+        )
+        .order_by(Entry.entry_date, Entry.created_at)
+        .all()
+    )
+
+    # 日付でまとめる (日付順に並んでいるので groupby でよい)
+    entries_by_date = {
+        d: list(rows)
+        for d, rows in groupby(month_entries, key=attrgetter("entry_date"))
+    }
 
     return render_template(
         "index.html",
@@ -236,6 +428,9 @@ def index():
 
 # ログイン
 
+# 存在しないユーザ名でのログイン時に照合するダミーのハッシュ
+_DUMMY_HASH = generate_password_hash("dummy-password")
+
 
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -244,7 +439,10 @@ def login():
         password = request.form["password"]
 
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password):
+        if user is None:
+            # ユーザが存在しなくても同じだけハッシュ計算をして, 応答時間の差をなくす
+            check_password_hash(_DUMMY_HASH, password)
+        elif user.check_password(password):
             login_user(user)
             return redirect(url_for("index"))
         flash("ユーザ名またはパスワードが違います. ")
@@ -275,28 +473,22 @@ def register():
 
 # 日のエントリ一覧
 
+# 1 日あたりに表示するエントリの上限
+DAY_ENTRIES_LIMIT = 500
 
-@app.route("/day/<date_str>")
-@login_required
-def day_view(date_str: str):
-    try:
-        target_date = date.fromisoformat(date_str)
-    except ValueError:
-        abort(404)
-
-    start_jst = datetime.combine(target_date, datetime.min.time()).replace(tzinfo=JST)
-    end_jst = start_jst + timedelta(days=1)
-
-    start_dt = start_jst.astimezone(timezone.utc)
-    end_dt = end_jst.astimezone(timezone.utc)
 
+@app.route("/day/<isodate:target_date>")
+@login_required
+def day_view(target_date: date):
+    # 一覧ではタイトルだけ出す. 本文は entry_view で読む
     day_entries = (
-        Entry.query.filter(
+        db.session.query(Entry.id, Entry.title, Entry.created_at)
+        .filter(
             Entry.user_id == current_user.id,
-            Entry.created_at >= start_dt,
-            Entry.created_at < end_dt,
+            Entry.entry_date == target_date,
         )
         .order_by(Entry.created_at.asc())
+        .limit(DAY_ENTRIES_LIMIT)
         .all()
     )
 
@@ -310,80 +502,49 @@ def day_view(date_str: str):
 # エントリ
 
 
-@app.route("/day/<date_str>/entry/<int:entry_id>/")
+@app.route("/day/<isodate:target_date>/entry/<int:entry_id>/")
 @login_required
-def entry_view(date_str: str, entry_id: int):
-    try:
-        target_date = date.fromisoformat(date_str)
-    except ValueError:
-        abort(404)
-
-    entry = Entry.query.get_or_404(entry_id)
-
-    if entry.user_id != current_user.id:
-        abort(403)
-
-    # 標準時の指定 tzinfo は昔のデータだと存在しないかも
-    if entry.created_at.tzinfo is None:
-        entry.created_at = entry.created_at.replace(tzinfo=timezone.utc)
-    if entry.updated_at and entry.updated_at.tzinfo is None:
-        entry.updated_at = entry.updated_at.replace(tzinfo=timezone.utc)
+def entry_view(target_date: date, entry_id: int):
+    # 自分のエントリ以外は存在しないものとして 404
+    entry = (
+        Entry.query.options(undefer(Entry.body))
+        .filter_by(id=entry_id, user_id=current_user.id)
+        .first_or_404()
+    )
 
     created_jst = to_jst(entry.created_at)
     updated_jst = to_jst(entry.updated_at) if entry.updated_at else None
 
-    correct_date_str = created_jst.date().isoformat()
-    if correct_date_str != date_str:
+    correct_date = created_jst.date()
+    if correct_date != target_date:
         return redirect(
-            url_for("entry_view", date_str=correct_date_str, entry_id=entry.id)
+            url_for("entry_view", target_date=correct_date, entry_id=entry.id)
         )
 
-    raw_html = markdown(
-        entry.body,
-        extensions=[
-            "fenced_code",
-            "tables",
-            "sane_lists",
-            "pymdownx.superfences",
-            "pymdownx.highlight",
-            "pymdownx.tilde",
-            "pymdownx.tasklist",
-        ],
-        # コードブロックまわり
-        extension_configs={
-            "pymdownx.highlight": {
-                "use_pygments": True,
-                "noclasses": False,
-                "css_class": "highlight",
-                "linenums": True,
-            }
-        },
-    )
-    body_html = sanitize_html(raw_html)
-
-    entry.created_at = created_jst
-    entry.updated_at = updated_jst
+    body_html = render_body_html(entry.body)
 
+    # entry に書き戻すと dirty 扱いになって JST の値が保存されかねないので別で渡す
     return render_template(
-        "entry_view.html", target_date=target_date, entry=entry, body_html=body_html
+        "entry_view.html",
+        target_date=target_date,
+        entry=entry,
+        created_jst=created_jst,
+        updated_jst=updated_jst,
+        body_html=body_html,
     )
 
 
-@app.route("/day/<date_str>/entry/<int:entry_id>/edit", methods=["GET", "POST"])
+@app.route(
+    "/day/<isodate:target_date>/entry/<int:entry_id>/edit", methods=["GET", "POST"]
+)
 @login_required
-def edit_entry(date_str: str, entry_id: int):
-    try:
-        target_date = date.fromisoformat(date_str)
-    except ValueError:
-        abort(404)
-
-    entry = Entry.query.get_or_404(entry_id)
-
-    if entry.user_id != current_user.id:
-        abort(403)
-
-    if entry.created_at.tzinfo is None:
-        entry.created_at = entry.created_at.replace(tzinfo=timezone.utc)
+def edit_entry(target_date: date, entry_id: int):
+    # 自分のエントリ以外は存在しないものとして 404
+    entry = (
+        Entry.query.options(undefer(Entry.body))
+        .filter_by(id=entry_id, user_id=current_user.id)
+        .first_or_404()
+    )
 
     created_jst = to_jst(entry.created_at)
     if created_jst.date() != target_date:
@@ -396,9 +557,7 @@ def edit_entry(date_str: str, entry_id: int):
 
         # コミット後, 日付取得
         return redirect(
-            url_for(
-                "entry_view", date_str=created_jst.date().isoformat(), entry_id=entry.id
-            )
+            url_for("entry_view", target_date=created_jst.date(), entry_id=entry.id)
         )
 
     return render_template(
@@ -415,19 +574,11 @@ def markdown_preview():
     data = request.get_json(silent=True) or {}
     text = data.get("text", "") or ""
 
-    raw_html = markdown(
-        text,
-        extensions=[
-            "fenced_code",
-            "tables",
-            "sane_lists",
-            "pymdownx.superfences",
-            "pymdownx.highlight",
-            "pymdownx.tilde",
-            "pymdownx.tasklist",
-        ],
-    )
-    html = sanitize_html(raw_html)
+    # 空のときは変換するまでもない
+    if not text.strip():
+        return jsonify({"html": ""})
+
+    html = render_preview_html(text)
 
     return jsonify({"html": html})
 
@@ -445,13 +596,21 @@ def new_entry():
     if request.method == "POST":
         title = request.form["title"]
         body = request.form["body"]
-        entry = Entry(title=title, body=body, author=current_user)
+        # entry_date は作成時刻の JST での日付
+        now = utcnow()
+        entry = Entry(
+            title=title,
+            body=body,
+            author=current_user,
+            created_at=now,
+            entry_date=to_jst(now).date(),
+        )
         db.session.add(entry)
         db.session.commit()
 
-        # コミット後, 日付取得
-        date_str = entry.created_at.astimezone(JST).date().isoformat()
-        return redirect(url_for("entry_view", date_str=date_str, entry_id=entry.id))
+        return redirect(
+            url_for("entry_view", target_date=entry.entry_date, entry_id=entry.id)
+        )
     return render_template("new_entry.html")
 
 
@@ -467,6 +626,7 @@ def search():
     if q:
         results = (
             Entry.query
+            .options(undefer(Entry.body))
             .filter(Entry.user_id == current_user.id)
             .filter(
                 (Entry.title.contains(q)) |
@@ -487,11 +647,8 @@ def search():
 @app.route("/delete/<int:entry_id>", methods=["POST"])
 @login_required
 def delete_entry(entry_id):
-    # None ならば 404
-    entry = Entry.query.get_or_404(entry_id)
-
-    if entry.user_id != current_user.id:
-        abort(403)
+    # None または自分のエントリでなければ 404
+    entry = Entry.query.filter_by(id=entry_id, user_id=current_user.id).first_or_404()
 
     db.session.delete(entry)
     db.session.commit()
@@ -526,4 +683,4 @@ if __name__ == "__main__":
     # 重要: 以下は初期化のため, はじめの 1 回のみ行う (以降はコメントアウト)
     # with app.app_context():
     #    db.create_all()
-    app.run(debug=True)
+    app.run(debug=app.debug)
@@ -0,0 +1,25 @@
+"""add user/date indexes to entry
+
+Revision ID: 4c1e8b7a2f93
+Revises: 783d59a6f67d
+Create Date: 2026-10-15 21:10:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "4c1e8b7a2f93"
+down_revision = "783d59a6f67d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_entry_user_created", "entry", ["user_id", "created_at"])
+    op.create_index("ix_entry_user_date", "entry", ["user_id", "entry_date"])
+
+
+def downgrade():
+    op.drop_index("ix_entry_user_date", table_name="entry")
+    op.drop_index("ix_entry_user_created", table_name="entry")
@@ -45,16 +45,25 @@ def upgrade():
     op.add_column("entry", sa.Column("entry_date", sa.Date(), nullable=True))
 
     bind = op.get_bind()
-    rows = bind.execute(sa.text("SELECT id, created_at FROM entry")).fetchall()
-
-    for entry_id, created_at in rows:
-        entry_date = _to_entry_date(created_at)
-        if entry_date is None:
-            continue
+    if bind.dialect.name == "sqlite":
+        # SQLite なら DB 側で JST の日付を計算して 1 文で埋める
+        # オフセットつきの値も date() が UTC に直してから +9 時間してくれる
         bind.execute(
-            sa.text("UPDATE entry SET entry_date = :d WHERE id = :id"),
-            {"d": entry_date, "id": entry_id},
+            sa.text("UPDATE entry SET entry_date = date(created_at, '+9 hours')")
         )
+    else:
+        rows = bind.execute(sa.text("SELECT id, created_at FROM entry")).fetchall()
+        params = [
+            {"d": entry_date, "id": entry_id}
+            for entry_id, created_at in rows
+            if (entry_date := _to_entry_date(created_at)) is not None
+        ]
+        # まとめて渡すと executemany になる
+        if params:
+            bind.execute(
+                sa.text("UPDATE entry SET entry_date = :d WHERE id = :id"),
+                params,
+            )
 
     with op.batch_alter_table("entry") as batch:
         batch.alter_column("entry_date", existing_type=sa.Date(), nullable=False)